@@ -3,12 +3,20 @@
 # ✅ NSU por CNPJ na tabela nsu_nfs (lê + atualiza)
 # ✅ Salva TODOS os XMLs (mês atual e outros) em nfse_xml/<cnpj>/<AAAAMM>/...
 # ✅ Gera/atualiza ZIP do MÊS ANTERIOR a qualquer momento (se tiver novos XMLs)
+# ✅ Meses "sujos": só refaz ZIP de meses fechados que receberam XML novo (qualquer mês)
 # ✅ Para empresa e NÃO avança NSU em: 404 NENHUM_DOCUMENTO_LOCALIZADO / 400 REJEICAO (E2214 etc)
 # ✅ Trata 429 com cooldown
 # ✅ Upload Storage via PUT + upsert=true (mais compatível)
+# ✅ Spool local (SQLite): XML vai pro disco antes do NSU avançar; uploader drena p/ Storage
+# ✅ Registro de empresas em memória (sessão/cert, NSU, backoff 429) entre varreduras
+# ✅ ZIP montado em paralelo (download + compressão por membro), nível/modo configuráveis
+# ✅ Perfil opcional (NFS_PROFILE=1 / --profile): relatório por varredura (empresas x etapas)
+# ✅ Várias instâncias: lease por CNPJ com TTL + heartbeat (LEASE_BACKEND=sqlite|supabase)
+#    e meses sujos no mesmo store (ZIP refeito por qualquer nó)
 #
 # Requisitos:
 #   pip install requests lxml
+#   pip install zstandard   (opcional, só p/ ZIP_COMPRESSAO=zstd)
 #
 # Dica (recomendado): use SERVICE_ROLE no backend para não bater em RLS do Storage.
 #   export SUPABASE_SERVICE_ROLE="xxxxx"
@@ -16,21 +24,31 @@
 # Obs: não é seguro deixar keys no código em produção.
 
 # -*- coding: utf-8 -*-
+import io
 import os
 import re
+import sys
 import time
 import json
+import pstats
+import cProfile
+import functools
 import base64
 import gzip
 import socket
+import shutil
+import struct
 import zipfile
 import tempfile
 import hashlib
+import sqlite3
 import threading
+import contextlib
+import zlib
 import requests
 
-from datetime import date, timedelta, datetime
-from typing import Dict, Any, Optional, List, Tuple
+from datetime import date, timedelta, datetime, timezone
+from typing import Dict, Any, Optional, List, Tuple, Iterator
 from zoneinfo import ZoneInfo
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -38,6 +56,11 @@ from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from lxml import etree
 
+try:
+    import zstandard
+except ImportError:  # opcional
+    zstandard = None
+
 # =========================================================
 # === SUPABASE ============================================
 # =========================================================
@@ -51,6 +74,8 @@ SUPABASE_KEY = SUPABASE_SERVICE_ROLE or SUPABASE_ANON_KEY
 
 TABELA_CERTS = "certifica_dfe"
 TABELA_NSU   = "nsu_nfs"
+TABELA_LEASES = "nfs_leases"      # cnpj (pk), worker_id, expira_em (timestamptz)
+TABELA_MESES_SUJOS = "nfs_meses_sujos"  # cnpj, mes_cod (pk composta) — só com LEASE_BACKEND=supabase
 
 BUCKET_STORAGE = "imagens"
 
@@ -58,6 +83,11 @@ PASTA_XML    = "nfse_xml"         # XML solto
 PASTA_ZIPS   = "notas"            # ZIP do mês anterior
 PASTA_STATUS = "notas_status"     # hash p/ saber se ZIP mudou
 
+# meses com XML novo ainda sem ZIP refeito (sobrevive a restart)
+# Com LEASE_BACKEND ligado vão pro mesmo store do lease (qualquer nó refaz o ZIP);
+# o arquivo local fica só de reserva se o store compartilhado falhar.
+ARQUIVO_MESES_SUJOS = os.getenv("ARQUIVO_MESES_SUJOS", "nfs_meses_sujos.json")
+
 def supabase_headers(is_json: bool = False) -> Dict[str, str]:
     if not SUPABASE_KEY or "COLE_SUA" in SUPABASE_KEY:
         raise RuntimeError("Configure SUPABASE_SERVICE_ROLE (recomendado) ou SUPABASE_ANON_KEY.")
@@ -74,11 +104,46 @@ ADN_BASE = "https://adn.nfse.gov.br"
 START_NSU_DEFAULT = int(os.getenv("START_NSU", "0") or "0")
 MAX_NSU_DEFAULT   = int(os.getenv("MAX_NSU", "400") or "400")
 INTERVALO_LOOP_SEGUNDOS = int(os.getenv("INTERVALO_LOOP_SEGUNDOS", "90") or "90")
+ERRO_BACKOFF_MAX_SEGUNDOS = int(os.getenv("ERRO_BACKOFF_MAX_SEGUNDOS", "3600") or "3600")  # empresa que falha seguido
 
 # Evita 429 (não exagere)
 ADN_WORKERS    = int(os.getenv("ADN_WORKERS", "2") or "2")      # paralelismo
 ADN_BATCH_SIZE = int(os.getenv("ADN_BATCH_SIZE", "10") or "10") # bloco por rodada
 
+# ZIP mensal
+#   ZIP_COMPRESSAO: "deflate" (padrão, abre em qualquer lugar) | "store" (sem compressão)
+#                   | "zstd" (método 93, só p/ consumo interno; precisa do pacote zstandard)
+ZIP_COMPRESSAO = (os.getenv("ZIP_COMPRESSAO", "deflate") or "deflate").strip().lower()
+ZIP_NIVEL      = int(os.getenv("ZIP_NIVEL", "6") or "6")                          # deflate 0-9 / zstd 1-22 / -1 = padrão
+ZIP_WORKERS    = int(os.getenv("ZIP_WORKERS", str(os.cpu_count() or 2)) or "2")   # download + compressão
+
+# Perfil por varredura (desligado por padrão)
+#   NFS_PROFILE=1         (ou --profile)  -> tempos/bytes por empresa e etapa
+#   NFS_PROFILE=cprofile  (ou --cprofile) -> idem + dump .pstats da thread principal
+NFS_PROFILE = (os.getenv("NFS_PROFILE", "") or "").strip().lower()
+PERFIL_DIR  = os.getenv("PERFIL_DIR", "nfs_perfil")
+NFS_VERSAO  = os.getenv("NFS_VERSAO", "")   # vai no relatório p/ comparar releases
+
+# Leases (só necessário com mais de uma instância rodando)
+#   ""        -> desligado (uma instância só, comportamento antigo)
+#   "sqlite"  -> arquivo local compartilhado (mesma máquina / testes)
+#   "supabase"-> tabela TABELA_LEASES
+LEASE_BACKEND = (os.getenv("LEASE_BACKEND", "") or "").strip().lower()
+LEASE_DB_PATH = os.getenv("LEASE_DB_PATH", "nfs_leases.sqlite3")
+LEASE_TTL_SEGUNDOS = int(os.getenv("LEASE_TTL_SEGUNDOS", "300") or "300")
+LEASE_HEARTBEAT_SEGUNDOS = int(os.getenv("LEASE_HEARTBEAT_SEGUNDOS", "60") or "60")
+# ao terminar a empresa o lease fica mais esse tempo (outro nó não repete o CNPJ na mesma rodada)
+LEASE_SEGURAR_SEGUNDOS = int(os.getenv("LEASE_SEGURAR_SEGUNDOS") or str(INTERVALO_LOOP_SEGUNDOS))
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+# Spool local: ADN grava aqui, uploader em background envia pro Storage
+SPOOL_DB_PATH = os.getenv("SPOOL_DB_PATH", "nfs_spool.sqlite3")
+SPOOL_UPLOAD_WORKERS = int(os.getenv("SPOOL_UPLOAD_WORKERS", "4") or "4")
+SPOOL_LOTE = int(os.getenv("SPOOL_LOTE", "50") or "50")
+SPOOL_INTERVALO_SEGUNDOS = int(os.getenv("SPOOL_INTERVALO_SEGUNDOS", "5") or "5")
+SPOOL_CLAIM_SEGUNDOS = 300        # item pego e não resolvido volta pra fila depois disso
+SPOOL_BACKOFF_MAX_SEGUNDOS = 900
+
 # =========================================================
 # FUSO HORÁRIO (RONDÔNIA)
 # =========================================================
@@ -95,6 +160,9 @@ def mes_anterior_info() -> Tuple[str, str]:
     mes_slug = fim_mes_anterior.strftime("%Y-%m")
     return mes_cod, mes_slug
 
+def mes_atual_cod() -> str:
+    return hoje_ro().strftime("%Y%m")
+
 def mes_anterior_range_dt() -> Tuple[datetime, datetime]:
     hoje = hoje_ro()
     inicio_mes_atual = hoje.replace(day=1)
@@ -132,6 +200,153 @@ def is_vencido(venc: Any) -> bool:
     except Exception:
         return False
 
+# =========================================================
+# PERFIL (opt-in): spans de tempo + bytes por empresa/etapa
+# =========================================================
+# Tempos são inclusivos (fluxo_nfse_para_empresa inclui baixar_e_salvar..., etc.)
+# e somados entre threads, então etapas paralelas podem passar do tempo de parede.
+PERFIL_ATIVO = NFS_PROFILE in ("1", "true", "sim", "cprofile")
+PERFIL_CPROFILE = NFS_PROFILE == "cprofile"
+
+_perfil_lock = threading.Lock()
+_perfil_ctx = threading.local()
+_perfil_etapas: Dict[str, List[float]] = {}                # etapa -> [chamadas, segundos, bytes]
+_perfil_empresas: Dict[Tuple[str, str], List[float]] = {}  # (cnpj, etapa) -> [chamadas, segundos, bytes]
+_perfil_inicio = 0.0
+_perfil_cprof: Optional[cProfile.Profile] = None
+
+@contextlib.contextmanager
+def perfil_empresa(cnpj: str) -> Iterator[None]:
+    """Atribui os spans/bytes da thread atual a um CNPJ."""
+    anterior = getattr(_perfil_ctx, "cnpj", "")
+    _perfil_ctx.cnpj = cnpj
+    try:
+        yield
+    finally:
+        _perfil_ctx.cnpj = anterior
+
+def _perfil_somar(etapa: str, chamadas: int, segundos: float, nbytes: int) -> None:
+    cnpj = getattr(_perfil_ctx, "cnpj", "")
+    with _perfil_lock:
+        alvos = [_perfil_etapas.setdefault(etapa, [0, 0.0, 0])]
+        if cnpj:
+            alvos.append(_perfil_empresas.setdefault((cnpj, etapa), [0, 0.0, 0]))
+        for acc in alvos:
+            acc[0] += chamadas
+            acc[1] += segundos
+            acc[2] += nbytes
+
+def perfil_bytes(etapa: str, nbytes: int) -> None:
+    if PERFIL_ATIVO and nbytes:
+        _perfil_somar(etapa, 0, 0.0, int(nbytes))
+
+@contextlib.contextmanager
+def perfil_span(etapa: str) -> Iterator[None]:
+    if not PERFIL_ATIVO:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _perfil_somar(etapa, 1, time.perf_counter() - t0, 0)
+
+def perfilar(etapa: str):
+    """Decorator: mede a função como um span `etapa` (custo ~zero com perfil desligado)."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PERFIL_ATIVO:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _perfil_somar(etapa, 1, time.perf_counter() - t0, 0)
+        return wrapper
+    return deco
+
+def perfil_iniciar_varredura() -> None:
+    global _perfil_inicio, _perfil_cprof
+    if not PERFIL_ATIVO:
+        return
+    with _perfil_lock:
+        _perfil_etapas.clear()
+        _perfil_empresas.clear()
+    _perfil_inicio = time.perf_counter()
+    if PERFIL_CPROFILE:
+        _perfil_cprof = cProfile.Profile()
+        _perfil_cprof.enable()
+
+def perfil_relatorio_varredura(top: int = 20) -> Optional[str]:
+    """
+    Grava PERFIL_DIR/varredura_<ts>.json/.txt (e .pstats no modo cprofile).
+    Empresas ranqueadas pelo tempo de fluxo_nfse_para_empresa; etapas pelo tempo total.
+    Retorna o caminho do .json.
+    """
+    global _perfil_cprof
+    if not PERFIL_ATIVO:
+        return None
+
+    parede = time.perf_counter() - _perfil_inicio
+    with _perfil_lock:
+        etapas = {k: list(v) for k, v in _perfil_etapas.items()}
+        por_empresa: Dict[str, Dict[str, List[float]]] = {}
+        for (cnpj, etapa), v in _perfil_empresas.items():
+            por_empresa.setdefault(cnpj, {})[etapa] = list(v)
+
+    empresas = []
+    for cnpj, ets in por_empresa.items():
+        empresas.append({
+            "cnpj": cnpj,
+            "segundos": round(ets.get("fluxo_nfse_para_empresa", [0, 0.0, 0])[1], 4),
+            "bytes": int(sum(v[2] for v in ets.values())),
+            "etapas": {k: {"chamadas": int(v[0]), "segundos": round(v[1], 4), "bytes": int(v[2])} for k, v in ets.items()},
+        })
+    empresas.sort(key=lambda e: (e["segundos"], e["bytes"]), reverse=True)
+    ranking_etapas = sorted(
+        ({"etapa": k, "chamadas": int(v[0]), "segundos": round(v[1], 4), "bytes": int(v[2])} for k, v in etapas.items()),
+        key=lambda e: (e["segundos"], e["bytes"]), reverse=True,
+    )
+
+    os.makedirs(PERFIL_DIR, exist_ok=True)
+    carimbo = datetime.now(FUSO_RO).strftime("%Y%m%d_%H%M%S")
+    base = os.path.join(PERFIL_DIR, f"varredura_{carimbo}")
+    relatorio = {
+        "versao": NFS_VERSAO,
+        "worker": WORKER_ID,
+        "inicio_ro": carimbo,
+        "parede_segundos": round(parede, 4),
+        "etapas": ranking_etapas,
+        "empresas": empresas,
+    }
+
+    linhas = [f"Varredura {carimbo} | versão={NFS_VERSAO or '-'} | parede={parede:.1f}s | empresas={len(empresas)}", "", "ETAPAS (tempo inclusivo):"]
+    for e in ranking_etapas:
+        linhas.append(f"  {e['etapa']:<34} {e['segundos']:>10.2f}s  chamadas={e['chamadas']:<7} bytes={e['bytes']}")
+    linhas += ["", f"EMPRESAS (top {top}):"]
+    for e in empresas[:top]:
+        linhas.append(f"  {e['cnpj']}  {e['segundos']:>10.2f}s  bytes={e['bytes']}")
+
+    if _perfil_cprof is not None:
+        _perfil_cprof.disable()
+        _perfil_cprof.dump_stats(f"{base}.pstats")
+        out = io.StringIO()
+        pstats.Stats(_perfil_cprof, stream=out).sort_stats("cumulative").print_stats(30)
+        linhas += ["", "cProfile (thread principal, top 30 cumulativo):", out.getvalue()]
+        relatorio["pstats"] = f"{base}.pstats"
+        _perfil_cprof = None
+
+    with open(f"{base}.json", "w", encoding="utf-8") as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2)
+    with open(f"{base}.txt", "w", encoding="utf-8") as f:
+        f.write("\n".join(linhas) + "\n")
+
+    print(f"📊 Perfil da varredura: {base}.txt")
+    for linha in linhas[2:2 + 1 + min(len(ranking_etapas), 8)]:
+        print(linha)
+    return f"{base}.json"
+
 # =========================================================
 # SUPABASE: NSU
 # =========================================================
@@ -160,10 +375,10 @@ def supabase_get_last_nsu(cnpj: str) -> int:
         print(f"   ⚠️ Erro lendo NSU no Supabase: {e}")
         return START_NSU_DEFAULT
 
-def supabase_upsert_last_nsu(cnpj: str, nsu: int) -> None:
+def supabase_upsert_last_nsu(cnpj: str, nsu: int) -> bool:
     cnpj = somente_numeros(cnpj)
     if not cnpj:
-        return
+        return False
 
     url = f"{SUPABASE_URL}/rest/v1/{TABELA_NSU}"
     params = {"select": "id,cnpj,nsu", "cnpj": f"eq.{cnpj}", "limit": "1", "order": "id.desc"}
@@ -172,7 +387,7 @@ def supabase_upsert_last_nsu(cnpj: str, nsu: int) -> None:
         r = requests.get(url, headers=supabase_headers(), params=params, timeout=20)
         if r.status_code >= 400:
             print(f"   ⚠️ NSU GET(para upsert) falhou ({r.status_code}): {r.text[:200]}")
-            return
+            return False
 
         rows = r.json() or []
         if rows:
@@ -189,19 +404,21 @@ def supabase_upsert_last_nsu(cnpj: str, nsu: int) -> None:
             pr = requests.patch(patch_url, headers=supabase_headers(is_json=True), json=payload, timeout=20)
             if pr.status_code in (200, 204):
                 print(f"   ✅ NSU atualizado: cnpj={cnpj} nsu={new_nsu}")
-            else:
-                print(f"   ⚠️ NSU PATCH falhou ({pr.status_code}): {pr.text[:200]}")
-            return
+                return True
+            print(f"   ⚠️ NSU PATCH falhou ({pr.status_code}): {pr.text[:200]}")
+            return False
 
         payload = {"cnpj": cnpj, "nsu": float(int(nsu))}
         pr = requests.post(url, headers=supabase_headers(is_json=True), json=payload, timeout=20)
         if pr.status_code in (200, 201):
             print(f"   ✅ NSU criado: cnpj={cnpj} nsu={int(nsu)}")
-        else:
-            print(f"   ⚠️ NSU POST falhou ({pr.status_code}): {pr.text[:200]}")
+            return True
+        print(f"   ⚠️ NSU POST falhou ({pr.status_code}): {pr.text[:200]}")
+        return False
 
     except Exception as e:
         print(f"   ⚠️ Erro upsert NSU: {e}")
+        return False
 
 # =========================================================
 # SUPABASE: CERTIFICADOS
@@ -235,9 +452,182 @@ def criar_arquivos_cert_temp(cert_row: Dict[str, Any]) -> Tuple[str, str, str]:
     print(f"   ✔ Certificado temporário: {cert_path}")
     return cert_path, key_path, tmp_dir
 
+# =========================================================
+# LEASES: uma empresa por vez em todo o cluster
+# =========================================================
+# Cada instância só processa o CNPJ cujo lease conseguiu pegar.
+# Lease expira em LEASE_TTL_SEGUNDOS; o heartbeat renova enquanto a empresa roda.
+# Instância que caiu para de renovar -> após o TTL outra assume o CNPJ.
+# Ao terminar não apaga: o lease vale mais LEASE_SEGURAR_SEGUNDOS (≈ um intervalo do loop),
+# senão outro nó pegaria o CNPJ de novo logo em seguida na mesma rodada.
+# Obs: "agora" é o relógio de cada nó; mantenha TTL bem maior que o drift.
+
+def _lease_sqlite_conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(LEASE_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS leases ("
+        " cnpj TEXT PRIMARY KEY, worker_id TEXT NOT NULL, expira_em REAL NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS meses_sujos ("
+        " cnpj TEXT NOT NULL, mes_cod TEXT NOT NULL, PRIMARY KEY (cnpj, mes_cod))"
+    )
+    return conn
+
+def _lease_sqlite_adquirir(cnpj: str) -> bool:
+    agora = time.time()
+    with contextlib.closing(_lease_sqlite_conn()) as conn:
+        conn.execute(
+            "INSERT INTO leases (cnpj, worker_id, expira_em) VALUES (?, ?, ?) "
+            "ON CONFLICT(cnpj) DO UPDATE SET worker_id = excluded.worker_id, expira_em = excluded.expira_em "
+            "WHERE leases.worker_id = excluded.worker_id OR leases.expira_em < ?",
+            (cnpj, WORKER_ID, agora + LEASE_TTL_SEGUNDOS, agora),
+        )
+        row = conn.execute("SELECT worker_id FROM leases WHERE cnpj = ?", (cnpj,)).fetchone()
+        return bool(row) and row[0] == WORKER_ID
+
+def _lease_sqlite_renovar(cnpj: str) -> bool:
+    with contextlib.closing(_lease_sqlite_conn()) as conn:
+        cur = conn.execute(
+            "UPDATE leases SET expira_em = ? WHERE cnpj = ? AND worker_id = ?",
+            (time.time() + LEASE_TTL_SEGUNDOS, cnpj, WORKER_ID),
+        )
+        return cur.rowcount == 1
+
+def _lease_sqlite_liberar(cnpj: str) -> None:
+    with contextlib.closing(_lease_sqlite_conn()) as conn:
+        conn.execute(
+            "UPDATE leases SET expira_em = ? WHERE cnpj = ? AND worker_id = ?",
+            (time.time() + LEASE_SEGURAR_SEGUNDOS, cnpj, WORKER_ID),
+        )
+
+def _iso_utc(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+
+def _lease_supabase_adquirir(cnpj: str) -> bool:
+    url = f"{SUPABASE_URL}/rest/v1/{TABELA_LEASES}"
+    agora = time.time()
+    payload = {"cnpj": cnpj, "worker_id": WORKER_ID, "expira_em": _iso_utc(agora + LEASE_TTL_SEGUNDOS)}
+
+    # 1) lease novo (ignora se já existe linha)
+    h = supabase_headers(is_json=True)
+    h["Prefer"] = "resolution=ignore-duplicates,return=representation"
+    r = requests.post(url, headers=h, json=payload, timeout=20)
+    if r.status_code >= 400:
+        raise RuntimeError(f"LEASE POST {r.status_code}: {r.text[:200]}")
+    if r.json():
+        return True
+
+    # 2) linha existe: só toma se é nossa ou se expirou (UPDATE condicional = atômico)
+    h = supabase_headers(is_json=True)
+    h["Prefer"] = "return=representation"
+    params = {"cnpj": f"eq.{cnpj}", "or": f'(worker_id.eq."{WORKER_ID}",expira_em.lt."{_iso_utc(agora)}")'}
+    r = requests.patch(url, headers=h, params=params, json=payload, timeout=20)
+    if r.status_code >= 400:
+        raise RuntimeError(f"LEASE PATCH {r.status_code}: {r.text[:200]}")
+    return bool(r.json())
+
+def _lease_supabase_renovar(cnpj: str) -> bool:
+    url = f"{SUPABASE_URL}/rest/v1/{TABELA_LEASES}"
+    h = supabase_headers(is_json=True)
+    h["Prefer"] = "return=representation"
+    params = {"cnpj": f"eq.{cnpj}", "worker_id": f"eq.{WORKER_ID}"}
+    payload = {"expira_em": _iso_utc(time.time() + LEASE_TTL_SEGUNDOS)}
+    r = requests.patch(url, headers=h, params=params, json=payload, timeout=20)
+    if r.status_code >= 400:
+        raise RuntimeError(f"LEASE RENOVAR {r.status_code}: {r.text[:200]}")
+    return bool(r.json())
+
+def _lease_supabase_liberar(cnpj: str) -> None:
+    url = f"{SUPABASE_URL}/rest/v1/{TABELA_LEASES}"
+    params = {"cnpj": f"eq.{cnpj}", "worker_id": f"eq.{WORKER_ID}"}
+    payload = {"expira_em": _iso_utc(time.time() + LEASE_SEGURAR_SEGUNDOS)}
+    r = requests.patch(url, headers=supabase_headers(is_json=True), params=params, json=payload, timeout=20)
+    if r.status_code >= 400:
+        raise RuntimeError(f"LEASE LIBERAR {r.status_code}: {r.text[:200]}")
+
+_LEASE_BACKENDS = {
+    "sqlite": (_lease_sqlite_adquirir, _lease_sqlite_renovar, _lease_sqlite_liberar),
+    "supabase": (_lease_supabase_adquirir, _lease_supabase_renovar, _lease_supabase_liberar),
+}
+
+def validar_lease_backend() -> None:
+    """LEASE_BACKEND desconhecido não pode virar "sem lease" calado: várias instâncias pegariam o mesmo CNPJ."""
+    if LEASE_BACKEND and LEASE_BACKEND not in _LEASE_BACKENDS:
+        raise RuntimeError(
+            f"LEASE_BACKEND inválido ({LEASE_BACKEND}). Use vazio ou um de: {', '.join(sorted(_LEASE_BACKENDS))}"
+        )
+
+@contextlib.contextmanager
+def lease_empresa(cnpj: str) -> Iterator[Optional[threading.Event]]:
+    """
+    Tenta pegar o lease do CNPJ.
+    Yield:
+      None            -> outra instância está com a empresa (pular)
+      threading.Event -> lease nosso; fica "set" se o heartbeat perder o lease
+    Com LEASE_BACKEND vazio sempre concede (uma instância só).
+    """
+    validar_lease_backend()
+    perdido = threading.Event()
+    backend = _LEASE_BACKENDS.get(LEASE_BACKEND)
+    if backend is None:
+        yield perdido
+        return
+
+    adquirir, renovar, liberar = backend
+    inicio = time.monotonic()  # lease vale no máximo TTL a partir daqui
+    try:
+        ok = adquirir(cnpj)
+    except Exception as e:
+        print(f"   ⚠️ Erro ao pegar lease ({cnpj}): {e}")
+        ok = False
+    if not ok:
+        yield None
+        return
+
+    parar = threading.Event()
+
+    # sem conseguir renovar, o lease expira sozinho: desiste uma batida antes do TTL
+    margem = min(LEASE_HEARTBEAT_SEGUNDOS, LEASE_TTL_SEGUNDOS / 2)
+
+    def heartbeat():
+        ultimo_ok = inicio
+        while not parar.wait(LEASE_HEARTBEAT_SEGUNDOS):
+            tentativa = time.monotonic()
+            try:
+                ok = renovar(cnpj)
+            except Exception as e:
+                print(f"   ⚠️ Heartbeat do lease falhou ({cnpj}): {e}")
+                ok = None
+            if ok:
+                ultimo_ok = tentativa
+                continue
+            if ok is False:
+                print(f"   ⚠️ Lease perdido para outra instância: cnpj={cnpj}")
+                perdido.set()
+                return
+            if time.monotonic() - ultimo_ok >= LEASE_TTL_SEGUNDOS - margem:
+                print(f"   ⚠️ Lease expirado sem renovação: cnpj={cnpj}")
+                perdido.set()
+                return
+
+    t = threading.Thread(target=heartbeat, name=f"lease-{cnpj}", daemon=True)
+    t.start()
+    try:
+        yield perdido
+    finally:
+        parar.set()
+        t.join(timeout=5)
+        if not perdido.is_set():
+            try:
+                liberar(cnpj)
+            except Exception as e:
+                print(f"   ⚠️ Erro ao liberar lease ({cnpj}): {e}")
+
 # =========================================================
 # STORAGE (Supabase) — PUT + upsert=true
 # =========================================================
+@perfilar("storage_list")
 def storage_list(prefix: str, search: Optional[str] = None, limit: int = 1000) -> List[Dict[str, Any]]:
     prefix = prefix.strip("/")
     url = f"{SUPABASE_URL}/storage/v1/object/list/{BUCKET_STORAGE}"
@@ -266,15 +656,19 @@ def storage_exists(path: str) -> bool:
     except Exception:
         return False
 
+@perfilar("storage_download")
 def storage_download(path: str) -> Optional[bytes]:
     path = path.lstrip("/")
     url = f"{SUPABASE_URL}/storage/v1/object/{BUCKET_STORAGE}/{path}"
     r = requests.get(url, headers=supabase_headers(), timeout=180)
     if r.status_code == 200:
+        perfil_bytes("storage_download", len(r.content))
         return r.content
     return None
 
+@perfilar("storage_upload")
 def storage_upload(path: str, content: bytes, content_type: str, upsert: bool = False) -> bool:
+    perfil_bytes("storage_upload", len(content))
     path = path.lstrip("/")
     url = f"{SUPABASE_URL}/storage/v1/object/{BUCKET_STORAGE}/{path}"
     headers = supabase_headers()
@@ -293,36 +687,82 @@ def storage_upload(path: str, content: bytes, content_type: str, upsert: bool =
 # =========================================================
 # XML decode/extract
 # =========================================================
-def decode_xml_field(value: str) -> Optional[str]:
+# Formato da resposta do ADN (GET /contribuintes/DFe/{nsu}):
+#   {"StatusProcessamento": ..., "LoteDFe": [{"NSU", "ChaveAcesso", "ArquivoXml": <base64(gzip(xml))>, ...}], ...}
+ADN_CAMPO_LOTE = "LoteDFe"
+ADN_CAMPOS_XML = ("ArquivoXml",)
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_BOM_WS = b"\xef\xbb\xbf \t\r\n"
+
+def decode_xml_bytes(value: Any) -> Optional[bytes]:
+    """
+    Decodifica um campo do JSON em XML (bytes) só se o começo indicar payload:
+    XML puro ('<') ou base64 cujos primeiros bytes são gzip ou '<' (com BOM/espaços).
+    Datas, códigos, mensagens etc. são descartados sem decodificar o valor inteiro.
+    """
     if not isinstance(value, str) or not value:
         return None
-    if value.lstrip().startswith("<"):
-        return value
+    c = value[0]
+    if c == "<" or (c.isspace() and value.lstrip().startswith("<")):
+        return value.encode("utf-8", errors="ignore")
+
+    # checagem barata: só os 6 primeiros bytes (8 chars de base64)
     try:
-        b = base64.b64decode(value, validate=False)
+        cabeca = base64.b64decode(value[:8], validate=False)
     except Exception:
         return None
+    resto = cabeca.lstrip(_BOM_WS)
+    if cabeca[:2] != _GZIP_MAGIC and resto and not resto.startswith(b"<"):
+        return None
+
     try:
-        return gzip.decompress(b).decode("utf-8", errors="replace")
+        b = base64.b64decode(value, validate=False)
     except Exception:
+        return None
+    if b[:2] == _GZIP_MAGIC:
         try:
-            return b.decode("utf-8", errors="replace")
+            b = gzip.decompress(b)
         except Exception:
             return None
+    if not b[:64].lstrip(_BOM_WS).startswith(b"<"):
+        return None
+    return b
 
-def find_xmls(data: Any) -> List[str]:
-    xmls: List[str] = []
+@perfilar("find_xmls")
+def find_xmls(data: Any) -> List[bytes]:
+    """
+    Extrai os XMLs (bytes) da resposta do ADN.
+    Caminho rápido: LoteDFe[*].ArquivoXml; se não vier nesse formato, varre o JSON.
+    """
+    if isinstance(data, dict):
+        lote = data.get(ADN_CAMPO_LOTE)
+        if isinstance(lote, list):
+            xmls: List[bytes] = []
+            for item in lote:
+                if not isinstance(item, dict):
+                    continue
+                for campo in ADN_CAMPOS_XML:
+                    xml = decode_xml_bytes(item.get(campo))
+                    if xml is not None:
+                        xmls.append(xml)
+            if xmls:
+                return xmls
+    return _find_xmls_generico(data)
+
+def _find_xmls_generico(data: Any) -> List[bytes]:
+    xmls: List[bytes] = []
     if isinstance(data, dict):
         for v in data.values():
             if isinstance(v, str):
-                xml = decode_xml_field(v)
-                if xml and xml.strip().startswith("<"):
+                xml = decode_xml_bytes(v)
+                if xml is not None:
                     xmls.append(xml)
             else:
-                xmls.extend(find_xmls(v))
+                xmls.extend(_find_xmls_generico(v))
     elif isinstance(data, list):
         for item in data:
-            xmls.extend(find_xmls(item))
+            xmls.extend(_find_xmls_generico(item))
     return xmls
 
 def parse_possible_date(texto: str) -> Optional[datetime]:
@@ -343,9 +783,9 @@ def parse_possible_date(texto: str) -> Optional[datetime]:
             pass
     return None
 
-def xml_in_period(xml_str: str, data_ini: datetime, data_fim: datetime) -> bool:
+def xml_in_period(xml: bytes, data_ini: datetime, data_fim: datetime) -> bool:
     try:
-        root = etree.fromstring(xml_str.encode("utf-8", errors="ignore"))
+        root = etree.fromstring(xml)
         nodes = root.xpath(
             "//*[contains(translate(local-name(), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'),'data') "
             "or contains(translate(local-name(), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'),'compet')]"
@@ -358,13 +798,13 @@ def xml_in_period(xml_str: str, data_ini: datetime, data_fim: datetime) -> bool:
         pass
     return False
 
-def extrair_mes_cod_do_xml(xml_str: str) -> Optional[str]:
+def extrair_mes_cod_do_xml(xml: bytes) -> Optional[str]:
     """
     Extrai AAAAMM do XML com base em tags que contenham 'data' ou 'compet'.
     Se não achar, retorna None.
     """
     try:
-        root = etree.fromstring(xml_str.encode("utf-8", errors="ignore"))
+        root = etree.fromstring(xml)
         nodes = root.xpath(
             "//*[contains(translate(local-name(), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'),'data') "
             "or contains(translate(local-name(), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ','abcdefghijklmnopqrstuvwxyz'),'compet')]"
@@ -377,8 +817,8 @@ def extrair_mes_cod_do_xml(xml_str: str) -> Optional[str]:
         pass
     return None
 
-def xml_hash_short(xml_str: str) -> str:
-    return hashlib.sha1(xml_str.encode("utf-8", errors="ignore")).hexdigest()[:16]
+def xml_hash_short(xml: bytes) -> str:
+    return hashlib.sha1(xml).hexdigest()[:16]
 
 def _extrair_codigo_erro(data_json: dict) -> str:
     try:
@@ -414,27 +854,397 @@ def criar_sessao_adn(cert_path: str, key_path: str) -> requests.Session:
     s.mount("https://", HTTPAdapter(max_retries=retries))
     return s
 
+# =========================================================
+# MESES SUJOS (cnpj, AAAAMM) -> ZIP precisa ser refeito
+# =========================================================
+_meses_sujos_lock = threading.Lock()
+_meses_sujos: Dict[str, set] = {}
+_meses_sujos_carregados = False
+_zip_bootstrap_feito: set = set()
+
+def _carregar_meses_sujos() -> None:
+    global _meses_sujos_carregados
+    if _meses_sujos_carregados:
+        return
+    _meses_sujos_carregados = True
+    try:
+        with open(ARQUIVO_MESES_SUJOS, "r", encoding="utf-8") as f:
+            data = json.load(f) or {}
+        for cnpj, meses in data.items():
+            _meses_sujos[cnpj] = set(meses or [])
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"   ⚠️ Falha ao ler {ARQUIVO_MESES_SUJOS}: {e}")
+
+def _persistir_meses_sujos() -> None:
+    data = {cnpj: sorted(meses) for cnpj, meses in _meses_sujos.items() if meses}
+    tmp = f"{ARQUIVO_MESES_SUJOS}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, ARQUIVO_MESES_SUJOS)
+    except Exception as e:
+        print(f"   ⚠️ Falha ao gravar {ARQUIVO_MESES_SUJOS}: {e}")
+
+# ---- store compartilhado (mesmo backend do lease) ----
+# Sem isso o mês marcado num nó só seria refeito quando o lease do CNPJ caísse nele de novo.
+
+def _sujos_sqlite_marcar(cnpj: str, mes_cod: str) -> None:
+    with contextlib.closing(_lease_sqlite_conn()) as conn:
+        conn.execute("INSERT OR IGNORE INTO meses_sujos (cnpj, mes_cod) VALUES (?, ?)", (cnpj, mes_cod))
+
+def _sujos_sqlite_pegar(cnpj: str, antes_de: str) -> List[str]:
+    with contextlib.closing(_lease_sqlite_conn()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT mes_cod FROM meses_sujos WHERE cnpj = ? AND mes_cod < ?", (cnpj, antes_de)
+            ).fetchall()
+            conn.execute("DELETE FROM meses_sujos WHERE cnpj = ? AND mes_cod < ?", (cnpj, antes_de))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return [r[0] for r in rows]
+
+def _sujos_supabase_marcar(cnpj: str, mes_cod: str) -> None:
+    url = f"{SUPABASE_URL}/rest/v1/{TABELA_MESES_SUJOS}"
+    h = supabase_headers(is_json=True)
+    h["Prefer"] = "resolution=ignore-duplicates,return=minimal"
+    r = requests.post(url, headers=h, json={"cnpj": cnpj, "mes_cod": mes_cod}, timeout=20)
+    if r.status_code >= 400:
+        raise RuntimeError(f"MESES SUJOS POST {r.status_code}: {r.text[:200]}")
+
+def _sujos_supabase_pegar(cnpj: str, antes_de: str) -> List[str]:
+    url = f"{SUPABASE_URL}/rest/v1/{TABELA_MESES_SUJOS}"
+    h = supabase_headers()
+    h["Prefer"] = "return=representation"
+    params = {"cnpj": f"eq.{cnpj}", "mes_cod": f"lt.{antes_de}"}
+    r = requests.delete(url, headers=h, params=params, timeout=20)
+    if r.status_code >= 400:
+        raise RuntimeError(f"MESES SUJOS DELETE {r.status_code}: {r.text[:200]}")
+    return [row["mes_cod"] for row in (r.json() or [])]
+
+_MESES_SUJOS_BACKENDS = {
+    "sqlite": (_sujos_sqlite_marcar, _sujos_sqlite_pegar),
+    "supabase": (_sujos_supabase_marcar, _sujos_supabase_pegar),
+}
+
+def _marcar_mes_sujo_local(cnpj: str, mes_cod: str) -> None:
+    with _meses_sujos_lock:
+        _carregar_meses_sujos()
+        meses = _meses_sujos.setdefault(cnpj, set())
+        if mes_cod in meses:
+            return
+        meses.add(mes_cod)
+        _persistir_meses_sujos()
+
+def marcar_mes_sujo(cnpj: str, mes_cod: str) -> None:
+    cnpj = somente_numeros(cnpj)
+    if not cnpj or not mes_cod:
+        return
+    backend = _MESES_SUJOS_BACKENDS.get(LEASE_BACKEND)
+    if backend is not None:
+        try:
+            backend[0](cnpj, mes_cod)
+            return
+        except Exception as e:
+            print(f"   ⚠️ Meses sujos compartilhados indisponíveis ({e}). Guardando local: {cnpj} {mes_cod}")
+    _marcar_mes_sujo_local(cnpj, mes_cod)
+
+def pegar_meses_sujos(cnpj: str, antes_de: str) -> List[str]:
+    """
+    Retira e retorna os meses sujos do cnpj anteriores a `antes_de` (AAAAMM).
+    O mês corrente continua sujo até fechar (ZIP só de mês fechado).
+    Junta o store compartilhado (se houver) com o que ficou local por falha dele.
+    """
+    cnpj = somente_numeros(cnpj)
+    prontos = set()
+    backend = _MESES_SUJOS_BACKENDS.get(LEASE_BACKEND)
+    if backend is not None:
+        try:
+            prontos.update(backend[1](cnpj, antes_de))
+        except Exception as e:
+            print(f"   ⚠️ Falha ao ler meses sujos compartilhados ({cnpj}): {e}")
+
+    with _meses_sujos_lock:
+        _carregar_meses_sujos()
+        meses = _meses_sujos.get(cnpj) or set()
+        locais = {m for m in meses if m < antes_de}
+        if locais:
+            meses.difference_update(locais)
+            _persistir_meses_sujos()
+    return sorted(prontos | locais)
+
 # =========================================================
 # save XML solto (SALVA TODOS OS MESES)
 # =========================================================
-def salvar_xml_solto_storage(cnpj: str, mes_cod: str, nsu: int, idx: int, xml_str: str) -> bool:
+def xml_solto_path(cnpj: str, mes_cod: str, nsu: int, idx: int, xml: bytes) -> str:
     cnpj = somente_numeros(cnpj)
-    h = xml_hash_short(xml_str)
+    h = xml_hash_short(xml)
     nome = f"{nsu}_{idx:02d}_{h}.xml"
-    storage_path = f"{PASTA_XML}/{cnpj}/{mes_cod}/{nome}"
+    return f"{PASTA_XML}/{cnpj}/{mes_cod}/{nome}"
 
+def subir_xml_solto_storage(storage_path: str, cnpj: str, mes_cod: str, xml_bytes: bytes) -> Optional[bool]:
+    """
+    Retorna True (enviado agora), False (já existia) ou None (falhou, tentar de novo).
+    Em True/False o mês fica sujo: um "já existia" pode ser retry de um PUT que deu
+    certo sem resposta (ou crash antes de marcar). Marca a mais só custa o hash do ZIP.
+    """
     if storage_exists(storage_path):
+        marcar_mes_sujo(cnpj, mes_cod)
         return False
 
-    ok = storage_upload(storage_path, xml_str.encode("utf-8", errors="ignore"), "application/xml", upsert=False)
+    ok = storage_upload(storage_path, xml_bytes, "application/xml", upsert=False)
     if ok:
         print(f"   🧾 XML salvo: {storage_path}")
+        marcar_mes_sujo(cnpj, mes_cod)
         return True
-    return False
+
+    # PUT sem upsert falha se outro envio chegou antes -> não é erro
+    if storage_exists(storage_path):
+        marcar_mes_sujo(cnpj, mes_cod)
+        return False
+    return None
+
+# =========================================================
+# SPOOL local (SQLite) -> uploader p/ Storage
+# =========================================================
+# O NSU só é gravado no Supabase depois que os XMLs dele estão no spool.
+# Storage lento/fora do ar não segura o ADN nem perde XML: o item fica
+# no spool com backoff até subir.
+_spool_drenar_lock = threading.Lock()
+_spool_thread: Optional[threading.Thread] = None
+
+def _spool_conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(SPOOL_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS spool ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " storage_path TEXT NOT NULL UNIQUE,"
+        " cnpj TEXT NOT NULL,"
+        " mes_cod TEXT NOT NULL,"
+        " xml BLOB NOT NULL,"
+        " tentativas INTEGER NOT NULL DEFAULT 0,"
+        " proxima_em REAL NOT NULL DEFAULT 0,"
+        " criado_em REAL NOT NULL)"
+    )
+    return conn
+
+@perfilar("spool_gravar_xmls")
+def spool_gravar_xmls(cnpj: str, nsu: int, itens: List[Tuple[str, bytes]]) -> int:
+    """
+    Grava no spool (uma transação) os XMLs de um NSU: itens = [(mes_cod, xml), ...].
+    Retorna quantos entraram (repetidos são ignorados). Lança exceção se o disco falhar.
+    """
+    cnpj = somente_numeros(cnpj)
+    agora = time.time()
+    rows = []
+    for i, (mes_cod, xml) in enumerate(itens, start=1):
+        storage_path = xml_solto_path(cnpj, mes_cod, nsu, i, xml)
+        rows.append((storage_path, cnpj, mes_cod, xml, agora))
+
+    with contextlib.closing(_spool_conn()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            antes = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO spool (storage_path, cnpj, mes_cod, xml, criado_em) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            novos = conn.total_changes - antes
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return novos
+
+def _spool_pegar_lote(limite: int) -> List[Tuple[int, str, str, str, bytes, int]]:
+    agora = time.time()
+    with contextlib.closing(_spool_conn()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, storage_path, cnpj, mes_cod, xml, tentativas FROM spool"
+                " WHERE proxima_em <= ? ORDER BY id LIMIT ?",
+                (agora, int(limite)),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE spool SET proxima_em = ? WHERE id = ?",
+                [(agora + SPOOL_CLAIM_SEGUNDOS, r[0]) for r in rows],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return rows
+
+def _spool_enviar_item(row: Tuple[int, str, str, str, bytes, int]) -> bool:
+    _id, storage_path, cnpj, mes_cod, xml_bytes, _tent = row
+    try:
+        with perfil_empresa(cnpj):
+            return subir_xml_solto_storage(storage_path, cnpj, mes_cod, xml_bytes) is not None
+    except Exception as e:
+        print(f"   ⚠️ Spool: erro enviando {storage_path}: {e}")
+        return False
+
+def drenar_spool() -> Tuple[int, int]:
+    """
+    Envia pro Storage tudo que está vencido no spool.
+    Retorna (enviados, falhas). Falha volta com backoff exponencial.
+    """
+    enviados = 0
+    falhas = 0
+    with _spool_drenar_lock:
+        while True:
+            rows = _spool_pegar_lote(SPOOL_LOTE)
+            if not rows:
+                break
+
+            ok_ids: List[int] = []
+            falhos: List[Tuple[int, int]] = []
+            with ThreadPoolExecutor(max_workers=SPOOL_UPLOAD_WORKERS) as ex:
+                futs = {ex.submit(_spool_enviar_item, r): r for r in rows}
+                for fut in as_completed(futs):
+                    r = futs[fut]
+                    if fut.result():
+                        ok_ids.append(r[0])
+                    else:
+                        falhos.append((r[0], r[5] + 1))
+
+            agora = time.time()
+            with contextlib.closing(_spool_conn()) as conn:
+                conn.executemany("DELETE FROM spool WHERE id = ?", [(i,) for i in ok_ids])
+                conn.executemany(
+                    "UPDATE spool SET tentativas = ?, proxima_em = ? WHERE id = ?",
+                    [(t, agora + min(SPOOL_BACKOFF_MAX_SEGUNDOS, 5 * (2 ** min(t, 10))), i) for i, t in falhos],
+                )
+
+            enviados += len(ok_ids)
+            falhas += len(falhos)
+            if falhos and not ok_ids:
+                break  # Storage fora: espera o backoff
+    return enviados, falhas
+
+def _loop_uploader_spool() -> None:
+    while True:
+        try:
+            enviados, falhas = drenar_spool()
+            if enviados or falhas:
+                print(f"   📤 Spool: enviados={enviados} | falhas={falhas}")
+        except Exception as e:
+            print(f"   ⚠️ Spool: erro no uploader: {e}")
+        time.sleep(SPOOL_INTERVALO_SEGUNDOS)
+
+def iniciar_uploader_spool() -> None:
+    global _spool_thread
+    if _spool_thread is not None and _spool_thread.is_alive():
+        return
+    _spool_thread = threading.Thread(target=_loop_uploader_spool, name="spool-uploader", daemon=True)
+    _spool_thread.start()
+
+# =========================================================
+# REGISTRO DE EMPRESAS (estado que sobrevive entre varreduras)
+# =========================================================
+class ResultadoNSU:
+    """Resultado de uma passada de baixar_e_salvar_xmls_por_nsu."""
+    __slots__ = (
+        "xml_mes_anterior",   # XMLs do mês anterior gravados no spool
+        "xml_geral",          # XMLs gravados no spool (todos os meses)
+        "json_ok",
+        "max_nsu_ok",
+        "nao_avancar_nsu",
+        "motivo",
+        "cooldown_segundos",  # Retry-After do 429 (0 = sem bloqueio)
+    )
+
+    def __init__(self, start_nsu: int):
+        self.xml_mes_anterior = 0
+        self.xml_geral = 0
+        self.json_ok = 0
+        self.max_nsu_ok = start_nsu - 1  # fim da sequência contínua de NSUs no spool
+        self.nao_avancar_nsu = False
+        self.motivo = ""
+        self.cooldown_segundos = 0
+
+class EmpresaEstado:
+    """Estado por CNPJ mantido entre varreduras (sem reconstruir a cada ciclo)."""
+    __slots__ = (
+        "cnpj",
+        "cert_hash",       # sha1(pem+key) -> recria arquivos/sessão só se o cert mudar
+        "tmp_dir",
+        "sessao",
+        "ultimo_nsu",      # None = ler do Supabase
+        "ultimo_status",
+        "bloqueado_ate",   # epoch; 429 com Retry-After ou backoff de erro
+        "json_ok_total",
+        "xml_total",
+        "erros_seguidos",  # backoff exponencial p/ empresa que falha toda rodada
+    )
+
+    def __init__(self, cnpj: str):
+        self.cnpj = cnpj
+        self.cert_hash = ""
+        self.tmp_dir = ""
+        self.sessao: Optional[requests.Session] = None
+        self.ultimo_nsu: Optional[int] = None
+        self.ultimo_status = ""
+        self.bloqueado_ate = 0.0
+        self.json_ok_total = 0
+        self.xml_total = 0
+        self.erros_seguidos = 0
+
+    def registrar_erro(self, status: str) -> None:
+        self.ultimo_status = status
+        self.erros_seguidos += 1
+        espera = min(ERRO_BACKOFF_MAX_SEGUNDOS, INTERVALO_LOOP_SEGUNDOS * (2 ** min(self.erros_seguidos - 1, 10)))
+        self.bloqueado_ate = max(self.bloqueado_ate, time.time() + espera)
+        print(f"   ⏸️ Empresa com {self.erros_seguidos} erro(s) seguido(s) ({status}): nova tentativa em {espera}s")
+
+    def liberar_sessao(self) -> None:
+        if self.sessao is not None:
+            try:
+                self.sessao.close()
+            except Exception:
+                pass
+        self.sessao = None
+        if self.tmp_dir:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.tmp_dir = ""
+        self.cert_hash = ""
+
+REGISTRO_EMPRESAS: Dict[str, EmpresaEstado] = {}
+
+def registro_empresa(cnpj: str) -> EmpresaEstado:
+    estado = REGISTRO_EMPRESAS.get(cnpj)
+    if estado is None:
+        estado = EmpresaEstado(cnpj)
+        REGISTRO_EMPRESAS[cnpj] = estado
+    return estado
+
+def registro_podar(cnpjs_ativos: set) -> None:
+    for cnpj in [c for c in REGISTRO_EMPRESAS if c not in cnpjs_ativos]:
+        REGISTRO_EMPRESAS.pop(cnpj).liberar_sessao()
+
+def sessao_da_empresa(estado: EmpresaEstado, cert_row: Dict[str, Any]) -> requests.Session:
+    """Reaproveita arquivos de cert + sessão mTLS enquanto o certificado não mudar."""
+    cert_hash = hashlib.sha1(f"{cert_row.get('pem') or ''}|{cert_row.get('key') or ''}".encode("utf-8")).hexdigest()
+    if estado.sessao is not None and estado.cert_hash == cert_hash:
+        return estado.sessao
+
+    estado.liberar_sessao()
+    cert_path, key_path, tmp_dir = criar_arquivos_cert_temp(cert_row)
+    estado.tmp_dir = tmp_dir
+    estado.sessao = criar_sessao_adn(cert_path, key_path)
+    estado.cert_hash = cert_hash
+    return estado.sessao
 
 # =========================================================
 # downloader por NSU (paradas corretas)
 # =========================================================
+@perfilar("baixar_e_salvar_xmls_por_nsu")
 def baixar_e_salvar_xmls_por_nsu(
     s: requests.Session,
     cnpj: str,
@@ -442,54 +1252,39 @@ def baixar_e_salvar_xmls_por_nsu(
     max_nsu: int,
     workers: int = ADN_WORKERS,
     batch_size: int = ADN_BATCH_SIZE,
-) -> Tuple[int, int, int, bool, str, int]:
-    """
-    Retorna:
-      total_xml_salvos_mes_anterior,
-      total_json_ok,
-      max_nsu_ok,
-      nao_avancar_nsu,
-      motivo_nao_avancar,
-      total_xml_salvos_geral
-    """
+    lease_perdido: Optional[threading.Event] = None,
+) -> ResultadoNSU:
     data_ini, data_fim = mes_anterior_range_dt()
 
     nsu_atual = int(start_nsu)
     limite = int(start_nsu) + int(max_nsu)
 
-    total_xml_mes_anterior = 0
-    total_xml_geral = 0
-    total_json_ok = 0
-    max_nsu_ok = start_nsu - 1  # só NSU com JSON OK
-
-    nao_avancar_nsu = False
-    motivo_nao_avancar = ""
+    res = ResultadoNSU(int(start_nsu))
+    nsus_no_spool = set()  # NSUs com JSON OK e XMLs gravados no spool
 
     stop_event = threading.Event()
-    cooldown_seconds = 0
 
     def fetch_one(nsu: int):
         if stop_event.is_set():
             return nsu, None, None
         url = f"{ADN_BASE}/contribuintes/DFe/{nsu}?cnpjConsulta={cnpj}"
         try:
-            r = s.get(url, timeout=60)
+            with perfil_empresa(cnpj), perfil_span("adn_get"):
+                r = s.get(url, timeout=60)
             return nsu, r, None
         except Exception as e:
             return nsu, None, e
 
     def stop_now(motivo: str, only_if_no_json_ok: bool = True):
-        nonlocal nao_avancar_nsu, motivo_nao_avancar
-        if (not only_if_no_json_ok) or (total_json_ok == 0):
-            nao_avancar_nsu = True
-            motivo_nao_avancar = motivo
+        if (not only_if_no_json_ok) or (res.json_ok == 0):
+            res.nao_avancar_nsu = True
+            res.motivo = motivo
         stop_event.set()
 
     while nsu_atual < limite:
-        if cooldown_seconds > 0:
-            print(f"⏸️ Cooldown {cooldown_seconds}s por 429...")
-            time.sleep(cooldown_seconds)
-            cooldown_seconds = 0
+        if lease_perdido is not None and lease_perdido.is_set():
+            print("⚠️ Lease perdido. Parando empresa.")
+            break
 
         fim_lote = min(nsu_atual + batch_size, limite)
         nsus = list(range(nsu_atual, fim_lote))
@@ -509,21 +1304,22 @@ def baixar_e_salvar_xmls_por_nsu(
                     continue
                 if r is None:
                     continue
+                perfil_bytes("adn_get", len(r.content or b""))
 
                 ctype = (r.headers.get("Content-Type") or "").lower()
                 body_txt = (r.text or "").strip()
 
                 # 429
                 if r.status_code == 429:
-                    print(f"[NSU {nsu}] HTTP 429 (Too Many Requests). Parando lote e aguardando.")
+                    print(f"[NSU {nsu}] HTTP 429 (Too Many Requests). Parando empresa (cooldown no registro).")
                     ra = r.headers.get("Retry-After")
                     try:
-                        cooldown_seconds = int(ra) if ra else 60
+                        res.cooldown_segundos = int(ra) if ra else 60
                     except Exception:
-                        cooldown_seconds = 60
+                        res.cooldown_segundos = 60
 
                     # se ainda não teve nenhum OK, mantém NSU antigo
-                    if total_json_ok == 0:
+                    if res.json_ok == 0:
                         stop_now("RATE_LIMIT_429", only_if_no_json_ok=True)
                     else:
                         stop_event.set()
@@ -576,37 +1372,44 @@ def baixar_e_salvar_xmls_por_nsu(
                     print(f"[NSU {nsu}] JSON inválido ({e}).")
                     continue
 
-                total_json_ok += 1
-                if nsu > max_nsu_ok:
-                    max_nsu_ok = nsu
-
                 xmls = find_xmls(data)
-                salvos_nsu_geral = 0
-                salvos_nsu_mes_ant = 0
 
-                for i, xml in enumerate(xmls, start=1):
-                    # ✅ salva TODOS os meses, baseado na data do XML
-                    mes_xml = extrair_mes_cod_do_xml(xml) or datetime.now(FUSO_RO).strftime("%Y%m")
-                    if salvar_xml_solto_storage(cnpj=cnpj, mes_cod=mes_xml, nsu=nsu, idx=i, xml_str=xml):
-                        total_xml_geral += 1
-                        salvos_nsu_geral += 1
+                # ✅ salva TODOS os meses, baseado na data do XML
+                itens = [(extrair_mes_cod_do_xml(xml) or datetime.now(FUSO_RO).strftime("%Y%m"), xml) for xml in xmls]
+                try:
+                    spool_gravar_xmls(cnpj, nsu, itens)
+                except Exception as e:
+                    # ✅ sem spool não conta o NSU como OK (não pode avançar por cima dele)
+                    print(f"[NSU {nsu}] ❌ Falha gravando no spool ({e}). Parando empresa.")
+                    stop_now("SPOOL_FALHOU", only_if_no_json_ok=True)
+                    break
+
+                res.json_ok += 1
+                nsus_no_spool.add(nsu)
 
-                        # ✅ conta separadamente os do mês anterior (pra log)
-                        if xml_in_period(xml, data_ini, data_fim):
-                            total_xml_mes_anterior += 1
-                            salvos_nsu_mes_ant += 1
+                # ✅ conta separadamente os do mês anterior (pra log)
+                no_spool_mes_ant = sum(1 for _m, xml in itens if xml_in_period(xml, data_ini, data_fim))
+                res.xml_geral += len(itens)
+                res.xml_mes_anterior += no_spool_mes_ant
 
-                print(f"[NSU {nsu}] OK - XMLs encontrados: {len(xmls)} | XMLs salvos (geral): {salvos_nsu_geral} | mês anterior: {salvos_nsu_mes_ant}")
+                print(f"[NSU {nsu}] OK - XMLs encontrados: {len(xmls)} | no spool (geral): {len(itens)} | mês anterior: {no_spool_mes_ant}")
 
         if stop_event.is_set():
             break
 
         nsu_atual = fim_lote
 
-    return total_xml_mes_anterior, total_json_ok, max_nsu_ok, nao_avancar_nsu, motivo_nao_avancar, total_xml_geral
+    # ✅ NSU só avança pela sequência contínua desde start_nsu: resultados chegam fora
+    # de ordem e um NSU menor pode ter falhado/sido cancelado depois de um maior dar certo
+    n = int(start_nsu)
+    while n in nsus_no_spool:
+        n += 1
+    res.max_nsu_ok = n - 1
+
+    return res
 
 # =========================================================
-# ZIP auto-atualizável do mês anterior
+# ZIP auto-atualizável por mês (mês anterior + meses sujos)
 # =========================================================
 def _calc_state_hash(xml_names: List[str]) -> str:
     s = "\n".join(sorted(xml_names)).encode("utf-8", errors="ignore")
@@ -629,17 +1432,128 @@ def _write_month_status(cnpj: str, mes_cod: str, payload: Dict[str, Any]) -> Non
     p = _status_path(cnpj, mes_cod)
     storage_upload(p, json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json", upsert=True)
 
-def gerar_zip_mes_anterior_para_empresa(cnpj: str, user: str, codi: Optional[int]) -> None:
-    cnpj = somente_numeros(cnpj)
-    mes_cod, _ = mes_anterior_info()
+# ---------------------------------------------------------
+# Montagem do ZIP: cada membro é baixado e comprimido em paralelo
+# (zlib/zstd liberam o GIL), depois o arquivo é montado na ordem.
+# ---------------------------------------------------------
+_ZIP_METODOS = {"store": zipfile.ZIP_STORED, "deflate": zipfile.ZIP_DEFLATED, "zstd": 93}
+_ZIP_VERSAO = {zipfile.ZIP_STORED: 20, zipfile.ZIP_DEFLATED: 20, 93: 63}
+_ZIP_NIVEIS = {zipfile.ZIP_STORED: (0, 0), zipfile.ZIP_DEFLATED: (0, 9), 93: (1, 22)}
+_ZIP_NIVEL_PADRAO = {zipfile.ZIP_STORED: 0, zipfile.ZIP_DEFLATED: zlib.Z_DEFAULT_COMPRESSION, 93: 3}  # ZIP_NIVEL=-1
+
+def zip_config() -> Tuple[int, int]:
+    """
+    (método, nível) efetivos a partir de ZIP_COMPRESSAO/ZIP_NIVEL.
+    Cai pra deflate se o modo for inválido/indisponível e ajusta o nível à faixa do método.
+    """
+    metodo = _ZIP_METODOS.get(ZIP_COMPRESSAO)
+    if metodo is None:
+        print(f"   ⚠️ ZIP_COMPRESSAO inválido ({ZIP_COMPRESSAO}). Usando deflate.")
+        metodo = zipfile.ZIP_DEFLATED
+    elif metodo == 93 and zstandard is None:
+        print("   ⚠️ ZIP_COMPRESSAO=zstd sem o pacote zstandard. Usando deflate.")
+        metodo = zipfile.ZIP_DEFLATED
+
+    if ZIP_NIVEL == -1:
+        return metodo, _ZIP_NIVEL_PADRAO[metodo]
+    minimo, maximo = _ZIP_NIVEIS[metodo]
+    nivel = min(max(ZIP_NIVEL, minimo), maximo)
+    if nivel != ZIP_NIVEL and metodo != zipfile.ZIP_STORED:
+        print(f"   ⚠️ ZIP_NIVEL={ZIP_NIVEL} fora da faixa {minimo}-{maximo}. Usando {nivel}.")
+    return metodo, nivel
+
+def _zip_comprimir(dados: bytes, metodo: int, nivel: int) -> bytes:
+    if metodo == zipfile.ZIP_DEFLATED:
+        c = zlib.compressobj(nivel, zlib.DEFLATED, -15)  # deflate cru, como o zipfile grava
+        return c.compress(dados) + c.flush()
+    if metodo == 93:
+        return zstandard.ZstdCompressor(level=nivel).compress(dados)
+    return dados
+
+def _zip_descomprimir(dados: bytes, metodo: int) -> bytes:
+    if metodo == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(dados, -15)
+    if metodo == 93:
+        return zstandard.ZstdDecompressor().decompress(dados)
+    return dados
+
+def _zip_preparar_membro(obj_path: str, nome: str, metodo: int, nivel: int) -> Optional[Tuple[str, int, int, bytes]]:
+    """Baixa e comprime um membro. Retorna (nome, crc32, tamanho_original, dados) ou None."""
+    b = storage_download(obj_path)
+    if not b:
+        print(f"   ⚠️ Não baixou: {obj_path}")
+        return None
+    return nome, zlib.crc32(b), len(b), _zip_comprimir(b, metodo, nivel)
+
+def _zip_dos_datetime(ts: float) -> Tuple[int, int]:
+    t = time.localtime(ts)
+    dos_data = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    dos_hora = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return dos_hora, dos_data
 
+def _zip_montar(fp, membros: List[Tuple[str, int, int, bytes]], metodo: int, nivel: int) -> None:
+    """
+    Grava o ZIP com membros já comprimidos (sem ZIP64).
+    Acima de 65535 membros ou 4 GiB cai pro zipfile (descomprime e recomprime no mesmo nível;
+    zstd vira deflate, que é o que o zipfile sabe gravar).
+    """
+    total = sum(len(m[3]) + 30 + len(m[0].encode("utf-8")) for m in membros)
+    if len(membros) > 0xFFFF or total > 0xFFFFFFFF:
+        compress_type = metodo
+        if metodo == 93:
+            compress_type = zipfile.ZIP_DEFLATED
+            minimo, maximo = _ZIP_NIVEIS[compress_type]
+            nivel = min(max(nivel, minimo), maximo)
+            print(f"   ⚠️ ZIP64 ({len(membros)} membros): zstd não suportado no zipfile. Usando deflate nível {nivel}.")
+        compresslevel = nivel if compress_type != zipfile.ZIP_STORED else None
+        with zipfile.ZipFile(fp, mode="w", compression=compress_type, compresslevel=compresslevel,
+                             allowZip64=True) as z:
+            for nome, _crc, _tam, dados in membros:
+                z.writestr(nome, _zip_descomprimir(dados, metodo))
+        return
+
+    dos_hora, dos_data = _zip_dos_datetime(time.time())
+    versao = _ZIP_VERSAO[metodo]
+    central = []
+    offset = 0
+    for nome, crc, tam, dados in membros:
+        try:
+            nome_b = nome.encode("ascii")
+            flags = 0
+        except UnicodeEncodeError:
+            nome_b = nome.encode("utf-8")
+            flags = 0x800
+        header = struct.pack(
+            "<4s5H3L2H", b"PK\x03\x04", versao, flags, metodo, dos_hora, dos_data,
+            crc, len(dados), tam, len(nome_b), 0,
+        )
+        fp.write(header)
+        fp.write(nome_b)
+        fp.write(dados)
+        central.append(struct.pack(
+            "<4s6H3L5H2L", b"PK\x01\x02", (3 << 8) | versao, versao, flags, metodo, dos_hora, dos_data,
+            crc, len(dados), tam, len(nome_b), 0, 0, 0, 0, (0o100600 << 16), offset,
+        ) + nome_b)
+        offset += len(header) + len(nome_b) + len(dados)
+
+    cd = b"".join(central)
+    fp.write(cd)
+    fp.write(struct.pack("<4s4H2LH", b"PK\x05\x06", 0, 0, len(membros), len(membros), len(cd), offset, 0))
+
+@perfilar("gerar_zip_mes_para_empresa")
+def gerar_zip_mes_para_empresa(cnpj: str, user: str, codi: Optional[int], mes_cod: str) -> bool:
+    """
+    Gera/atualiza o ZIP de um mês (AAAAMM) se a lista de XMLs mudou.
+    Retorna False só em falha (lista/upload) -> mês deve continuar sujo.
+    """
+    cnpj = somente_numeros(cnpj)
     prefix = f"{PASTA_XML}/{cnpj}/{mes_cod}"
 
     try:
         itens = storage_list(prefix=prefix, limit=5000)
     except Exception as e:
         print(f"   ⚠️ Falha ao listar XMLs para ZIP ({cnpj} {mes_cod}): {e}")
-        return
+        return False
 
     xml_names = []
     for it in itens or []:
@@ -648,16 +1562,16 @@ def gerar_zip_mes_anterior_para_empresa(cnpj: str, user: str, codi: Optional[int
             xml_names.append(nm)
 
     if not xml_names:
-        print(f"   ℹ️ Sem XMLs do mês anterior {mes_cod} para cnpj={cnpj}. ZIP não gerado.")
-        return
+        print(f"   ℹ️ Sem XMLs do mês {mes_cod} para cnpj={cnpj}. ZIP não gerado.")
+        return True
 
     new_hash = _calc_state_hash(xml_names)
     old_status = _read_month_status(cnpj, mes_cod)
     old_hash = (old_status or {}).get("hash")
 
     if old_hash == new_hash:
-        print(f"   ℹ️ ZIP do mês anterior já está atualizado: cnpj={cnpj} mes={mes_cod}")
-        return
+        print(f"   ℹ️ ZIP do mês já está atualizado: cnpj={cnpj} mes={mes_cod}")
+        return True
 
     cod_str = str(codi) if codi is not None else "0"
     email = (user or "sem-user").replace("/", "_")
@@ -665,18 +1579,19 @@ def gerar_zip_mes_anterior_para_empresa(cnpj: str, user: str, codi: Optional[int
     nome_final = f"{mes_cod}-{cod_str}-{cnpj}-{email}-{zip_name}"
     storage_zip_path = f"{PASTA_ZIPS}/{nome_final}"
 
-    print(f"   📦 Atualizando ZIP do mês anterior {mes_cod}: {len(xml_names)} XMLs (cnpj={cnpj})...")
+    metodo, nivel = zip_config()
+    print(f"   📦 Atualizando ZIP do mês {mes_cod}: {len(xml_names)} XMLs (cnpj={cnpj}) | método={metodo} nível={nivel} workers={ZIP_WORKERS}...")
 
-    buf = tempfile.SpooledTemporaryFile(max_size=300 * 1024 * 1024)
-    with zipfile.ZipFile(buf, mode="w", compression=zipfile.ZIP_DEFLATED) as z:
-        for nm in sorted(xml_names):
-            obj_path = f"{prefix}/{nm}"
-            b = storage_download(obj_path)
-            if not b:
-                print(f"   ⚠️ Não baixou: {obj_path}")
-                continue
-            z.writestr(nm, b)
+    def preparar(nm: str):
+        with perfil_empresa(cnpj):
+            return _zip_preparar_membro(f"{prefix}/{nm}", nm, metodo, nivel)
+
+    nomes = sorted(xml_names)
+    with ThreadPoolExecutor(max_workers=max(1, ZIP_WORKERS)) as ex:
+        membros = [m for m in ex.map(preparar, nomes) if m]
 
+    buf = tempfile.SpooledTemporaryFile(max_size=300 * 1024 * 1024)
+    _zip_montar(buf, membros, metodo, nivel)
     buf.seek(0)
     zip_bytes = buf.read()
 
@@ -690,13 +1605,45 @@ def gerar_zip_mes_anterior_para_empresa(cnpj: str, user: str, codi: Optional[int
             "hash": new_hash,
             "updated_at": datetime.now(FUSO_RO).isoformat()
         })
-    else:
-        print(f"   ❌ Falha ao enviar ZIP: {storage_zip_path}")
+        return True
+
+    print(f"   ❌ Falha ao enviar ZIP: {storage_zip_path}")
+    return False
+
+def gerar_zips_meses_sujos_para_empresa(cnpj: str, user: str, codi: Optional[int]) -> None:
+    """
+    Refaz só os ZIPs de meses fechados marcados como sujos.
+    Empresa sem XML novo -> zero chamadas ao Storage.
+    Na 1ª passada do processo o mês anterior entra como sujo (cobre restart/virada de mês).
+    """
+    cnpj = somente_numeros(cnpj)
+    if cnpj not in _zip_bootstrap_feito:
+        _zip_bootstrap_feito.add(cnpj)
+        mes_ant, _ = mes_anterior_info()
+        marcar_mes_sujo(cnpj, mes_ant)
+
+    # ✅ mês só sai do conjunto se o ZIP deu certo (exceção/falha -> continua sujo)
+    meses = pegar_meses_sujos(cnpj, antes_de=mes_atual_cod())
+    feitos = set()
+    try:
+        for mes_cod in meses:
+            try:
+                ok = gerar_zip_mes_para_empresa(cnpj, user, codi, mes_cod)
+            except Exception as e:
+                print(f"   ⚠️ Erro gerando ZIP ({cnpj} {mes_cod}): {e}")
+                ok = False
+            if ok:
+                feitos.add(mes_cod)
+    finally:
+        for mes_cod in meses:
+            if mes_cod not in feitos:
+                marcar_mes_sujo(cnpj, mes_cod)
 
 # =========================================================
 # Fluxo por empresa
 # =========================================================
-def fluxo_nfse_para_empresa(cert_row: Dict[str, Any]):
+@perfilar("fluxo_nfse_para_empresa")
+def fluxo_nfse_para_empresa(cert_row: Dict[str, Any], lease_perdido: Optional[threading.Event] = None):
     empresa = cert_row.get("empresa") or ""
     user = cert_row.get("user") or ""
     codi = cert_row.get("codi")
@@ -714,53 +1661,83 @@ def fluxo_nfse_para_empresa(cert_row: Dict[str, Any]):
         return
 
     cnpj = doc
+    estado = registro_empresa(cnpj)
 
-    last_saved = supabase_get_last_nsu(cnpj)
+    # ✅ NSU em memória só vale com instância única (com lease outro nó pode ter avançado)
+    if estado.ultimo_nsu is None or LEASE_BACKEND:
+        estado.ultimo_nsu = supabase_get_last_nsu(cnpj)
+        origem_nsu = "Supabase"
+    else:
+        origem_nsu = "memória"
+    last_saved = estado.ultimo_nsu
     start_nsu = max(0, int(last_saved) + 1)
     max_nsu = MAX_NSU_DEFAULT
 
-    print(f"   🧠 NSU Supabase: last={last_saved} -> start={start_nsu} | max_nsu={max_nsu} | workers={ADN_WORKERS} batch={ADN_BATCH_SIZE}")
+    print(f"   🧠 NSU {origem_nsu}: last={last_saved} -> start={start_nsu} | max_nsu={max_nsu} | workers={ADN_WORKERS} batch={ADN_BATCH_SIZE}")
 
     try:
-        cert_path, key_path, _tmp_dir = criar_arquivos_cert_temp(cert_row)
-        s = criar_sessao_adn(cert_path, key_path)
+        s = sessao_da_empresa(estado, cert_row)
     except Exception as e:
         print("❌ Erro ao criar sessão/cert:", e)
+        estado.liberar_sessao()
+        estado.registrar_erro("ERRO_CERT")
         return
 
-    xml_mes_ant, json_ok, max_nsu_ok, nao_avancar_nsu, motivo, xml_geral = baixar_e_salvar_xmls_por_nsu(
+    res = baixar_e_salvar_xmls_por_nsu(
         s=s,
         cnpj=cnpj,
         start_nsu=start_nsu,
         max_nsu=max_nsu,
         workers=ADN_WORKERS,
         batch_size=ADN_BATCH_SIZE,
+        lease_perdido=lease_perdido,
     )
 
+    estado.json_ok_total += res.json_ok
+    estado.xml_total += res.xml_geral
+    estado.ultimo_status = res.motivo or ("OK" if res.json_ok else "SEM_JSON")
+    estado.erros_seguidos = 0
+    if res.cooldown_segundos > 0:
+        estado.bloqueado_ate = time.time() + res.cooldown_segundos
+        print(f"   ⏸️ Empresa em cooldown por 429: {res.cooldown_segundos}s")
+
+    # ✅ Sem lease não grava NSU nem ZIP (outra instância já assumiu a empresa)
+    if lease_perdido is not None and lease_perdido.is_set():
+        print("⚠️ Lease perdido: NSU e ZIP ficam para a instância que assumiu.")
+        estado.ultimo_nsu = None
+        return
+
     # ✅ Atualiza NSU somente se teve pelo menos 1 JSON OK e não caiu em "não avançar"
-    if nao_avancar_nsu and json_ok == 0:
-        print(f"ℹ️ Mantendo NSU antigo (não atualiza Supabase). Motivo: {motivo or 'NAO_AVANCAR'}")
+    if res.nao_avancar_nsu and res.json_ok == 0:
+        print(f"ℹ️ Mantendo NSU antigo (não atualiza Supabase). Motivo: {res.motivo or 'NAO_AVANCAR'}")
     else:
-        if json_ok > 0 and max_nsu_ok >= start_nsu:
-            supabase_upsert_last_nsu(cnpj, max_nsu_ok)
+        if res.json_ok > 0 and res.max_nsu_ok >= start_nsu:
+            if supabase_upsert_last_nsu(cnpj, res.max_nsu_ok):
+                estado.ultimo_nsu = max(int(last_saved), res.max_nsu_ok)
+            else:
+                estado.ultimo_nsu = None
         else:
-            print("ℹ️ Não atualizou NSU: nenhum JSON 200 processado.")
+            print("ℹ️ Não atualizou NSU: nenhum NSU contínuo desde o início foi pro spool.")
 
-    print(f"   🧾 XMLs salvos nesta rodada: geral={xml_geral} | mês anterior={xml_mes_ant} | JSONs OK={json_ok} | max_nsu_ok={max_nsu_ok}")
+    print(f"   🧾 XMLs no spool nesta rodada: geral={res.xml_geral} | mês anterior={res.xml_mes_anterior} | JSONs OK={res.json_ok} | max_nsu_ok={res.max_nsu_ok}")
 
-    # ✅ Atualiza ZIP do mês anterior (sempre que detectar mudança)
-    gerar_zip_mes_anterior_para_empresa(cnpj=cnpj, user=user, codi=codi)
+    # ✅ Atualiza ZIPs dos meses fechados que receberam XML novo
+    gerar_zips_meses_sujos_para_empresa(cnpj=cnpj, user=user, codi=codi)
 
 # =========================================================
 # LOOP
 # =========================================================
+@perfilar("processar_todas_empresas")
 def processar_todas_empresas():
+    iniciar_uploader_spool()
+
     certs = carregar_certificados_validos()
     if not certs:
         print("⚠️ Nenhum certificado encontrado.")
         return
 
     hoje = hoje_ro()
+    cnpjs_ativos = set()
 
     for cert_row in certs:
         empresa = cert_row.get("empresa") or "(sem empresa)"
@@ -783,10 +1760,30 @@ def processar_todas_empresas():
             print(f"\n⏭️ PULANDO (CPF/Inválido): {empresa} | doc={doc_raw} -> {doc}")
             continue
 
-        try:
-            fluxo_nfse_para_empresa(cert_row)
-        except Exception as e:
-            print(f"❌ Erro inesperado em {empresa}: {e}")
+        cnpjs_ativos.add(doc)
+        estado = REGISTRO_EMPRESAS.get(doc)
+        if estado is not None and estado.bloqueado_ate > time.time():
+            faltam = int(estado.bloqueado_ate - time.time())
+            motivo = "cooldown 429" if estado.erros_seguidos == 0 else f"backoff {estado.ultimo_status}"
+            print(f"\n⏭️ PULANDO ({motivo}, faltam {faltam}s): {empresa} | doc={doc}")
+            continue
+
+        with lease_empresa(doc) as lease_perdido:
+            if lease_perdido is None:
+                print(f"\n⏭️ PULANDO (lease com outra instância): {empresa} | doc={doc}")
+                continue
+            try:
+                with perfil_empresa(doc):
+                    fluxo_nfse_para_empresa(cert_row, lease_perdido=lease_perdido)
+            except Exception as e:
+                print(f"❌ Erro inesperado em {empresa}: {e}")
+                estado = REGISTRO_EMPRESAS.get(doc)
+                if estado is not None:
+                    estado.ultimo_nsu = None
+                    estado.registrar_erro("ERRO")
+
+    # ✅ empresa que saiu da tabela de certificados libera sessão/arquivos
+    registro_podar(cnpjs_ativos)
 
 def diagnostico_rede_basico():
     host = "adn.nfse.gov.br"
@@ -808,17 +1805,38 @@ def diagnostico_rede_basico():
 # EXECUÇÃO
 # =========================================================
 if __name__ == "__main__":
+    if "--cprofile" in sys.argv:
+        PERFIL_ATIVO = PERFIL_CPROFILE = True
+    elif "--profile" in sys.argv:
+        PERFIL_ATIVO = True
+    if PERFIL_ATIVO:
+        print(f"📊 Perfil ligado{' (cProfile)' if PERFIL_CPROFILE else ''}: relatórios em {PERFIL_DIR}/")
+
+    validar_lease_backend()
     diagnostico_rede_basico()
+    zip_metodo, zip_nivel = zip_config()
+    print(f"🗜️ ZIP: {ZIP_COMPRESSAO} -> método={zip_metodo} nível={zip_nivel} workers={ZIP_WORKERS}")
+    if LEASE_BACKEND:
+        print(
+            f"🔒 Leases: backend={LEASE_BACKEND} worker={WORKER_ID} ttl={LEASE_TTL_SEGUNDOS}s "
+            f"heartbeat={LEASE_HEARTBEAT_SEGUNDOS}s segurar={LEASE_SEGURAR_SEGUNDOS}s"
+        )
 
     while True:
         mes_cod, mes_slug = mes_anterior_info()
         print("\n\n==================== NOVA VARREDURA NFS-e ====================")
         print(f"📅 Data (fuso RO): {hoje_ro().strftime('%d/%m/%Y')} | ZIP alvo: mês anterior {mes_slug} ({mes_cod})")
 
+        perfil_iniciar_varredura()
         try:
             processar_todas_empresas()
         except Exception as e:
             print(f"💥 Erro inesperado no loop: {e}")
 
+        try:
+            perfil_relatorio_varredura()
+        except Exception as e:
+            print(f"⚠️ Falha ao gravar perfil: {e}")
+
         print(f"🕒 Aguardando {INTERVALO_LOOP_SEGUNDOS} segundos...\n")
         time.sleep(INTERVALO_LOOP_SEGUNDOS)
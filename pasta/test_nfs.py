@@ -0,0 +1,394 @@
+import base64
+import gzip
+import json
+import sqlite3
+import time
+import zipfile
+import zlib
+
+import pytest
+
+import nfs
+
+
+XML = b'<NFSe xmlns="http://www.sped.fazenda.gov.br/nfse"><infNFSe/></NFSe>'
+
+
+def b64(b: bytes) -> str:
+    return base64.b64encode(b).decode("ascii")
+
+
+# =========================================================
+# decode_xml_bytes / find_xmls
+# =========================================================
+def test_decode_xml_bytes_aceita_formatos_de_payload():
+    com_decl = b'<?xml version="1.0" encoding="UTF-8"?>' + XML
+    assert nfs.decode_xml_bytes(b64(gzip.compress(XML))) == XML
+    assert nfs.decode_xml_bytes(b64(com_decl)) == com_decl
+    assert nfs.decode_xml_bytes(b64(XML)) == XML                      # "PE..." (sem declaração)
+    assert nfs.decode_xml_bytes(b64(b"\xef\xbb\xbf" + XML)) == b"\xef\xbb\xbf" + XML  # "77u/" (BOM)
+    assert nfs.decode_xml_bytes(b64(b"\n  " + XML)) == b"\n  " + XML
+    assert nfs.decode_xml_bytes(XML.decode()) == XML
+
+
+def test_decode_xml_bytes_descarta_campos_que_nao_sao_xml():
+    for v in ("2026-01-01T00:00:00", "1" * 50, "DOCUMENTOS_LOCALIZADOS", "PDF", "", None, 123):
+        assert nfs.decode_xml_bytes(v) is None
+
+
+def test_find_xmls_lote_e_fallback_generico():
+    lote = {"StatusProcessamento": "DOCUMENTOS_LOCALIZADOS",
+            "LoteDFe": [{"NSU": 1, "ChaveAcesso": "1" * 50, "ArquivoXml": b64(XML)}]}
+    assert nfs.find_xmls(lote) == [XML]
+    assert nfs.find_xmls({"outro": [{"xml": b64(b"\xef\xbb\xbf" + XML)}], "data": "2026-01-01"}) == [b"\xef\xbb\xbf" + XML]
+
+
+# =========================================================
+# meses sujos
+# =========================================================
+def _isolar_meses_sujos(monkeypatch, tmp_path):
+    monkeypatch.setattr(nfs, "ARQUIVO_MESES_SUJOS", str(tmp_path / "sujos.json"))
+    monkeypatch.setattr(nfs, "_meses_sujos", {})
+    monkeypatch.setattr(nfs, "_meses_sujos_carregados", False)
+    monkeypatch.setattr(nfs, "_zip_bootstrap_feito", {"12345678000190"})
+    monkeypatch.setattr(nfs, "mes_atual_cod", lambda: "202603")
+
+
+def test_meses_sujos_continuam_sujos_se_zip_falhar(monkeypatch, tmp_path):
+    _isolar_meses_sujos(monkeypatch, tmp_path)
+    nfs.marcar_mes_sujo("12345678000190", "202601")
+    nfs.marcar_mes_sujo("12345678000190", "202602")
+    nfs.marcar_mes_sujo("12345678000190", "202603")  # mês corrente: não gera
+
+    chamados = []
+
+    def gerar(cnpj, user, codi, mes_cod):
+        chamados.append(mes_cod)
+        if mes_cod == "202601":
+            raise TimeoutError("storage")
+        return True
+
+    monkeypatch.setattr(nfs, "gerar_zip_mes_para_empresa", gerar)
+    nfs.gerar_zips_meses_sujos_para_empresa("12345678000190", "u", 1)
+
+    assert chamados == ["202601", "202602"]
+    monkeypatch.setattr(nfs, "_meses_sujos", {})
+    monkeypatch.setattr(nfs, "_meses_sujos_carregados", False)
+    assert nfs.pegar_meses_sujos("12345678000190", antes_de="209912") == ["202601", "202603"]
+
+
+# =========================================================
+# leases
+# =========================================================
+def _lease_sqlite(monkeypatch, tmp_path, ttl=2, heartbeat=1):
+    monkeypatch.setattr(nfs, "LEASE_BACKEND", "sqlite")
+    monkeypatch.setattr(nfs, "LEASE_DB_PATH", str(tmp_path / "leases.sqlite3"))
+    monkeypatch.setattr(nfs, "LEASE_TTL_SEGUNDOS", ttl)
+    monkeypatch.setattr(nfs, "LEASE_HEARTBEAT_SEGUNDOS", heartbeat)
+    monkeypatch.setattr(nfs, "WORKER_ID", "a")
+
+
+def test_lease_exclusivo_e_reassumido_apos_ttl(monkeypatch, tmp_path):
+    _lease_sqlite(monkeypatch, tmp_path, ttl=1)
+    assert nfs._lease_sqlite_adquirir("1")
+    monkeypatch.setattr(nfs, "WORKER_ID", "b")
+    assert not nfs._lease_sqlite_adquirir("1")
+    time.sleep(1.1)
+    assert nfs._lease_sqlite_adquirir("1")
+    monkeypatch.setattr(nfs, "WORKER_ID", "a")
+    assert not nfs._lease_sqlite_renovar("1")
+
+
+def test_lease_perdido_quando_renovacao_falha_ate_o_ttl(monkeypatch, tmp_path):
+    _lease_sqlite(monkeypatch, tmp_path, ttl=2, heartbeat=0.2)
+
+    def renovar_fora(cnpj):
+        raise TimeoutError("lease store fora")
+
+    monkeypatch.setitem(nfs._LEASE_BACKENDS, "sqlite",
+                        (nfs._lease_sqlite_adquirir, renovar_fora, nfs._lease_sqlite_liberar))
+    with nfs.lease_empresa("1") as perdido:
+        assert perdido is not None
+        time.sleep(1.0)
+        assert not perdido.is_set()
+        time.sleep(1.3)
+        assert perdido.is_set()
+
+
+def test_lease_segurado_apos_processar_ate_o_intervalo(monkeypatch, tmp_path):
+    _lease_sqlite(monkeypatch, tmp_path, ttl=30)
+    monkeypatch.setattr(nfs, "LEASE_SEGURAR_SEGUNDOS", 1)
+    with nfs.lease_empresa("1") as perdido:
+        assert perdido is not None
+    monkeypatch.setattr(nfs, "WORKER_ID", "b")
+    with nfs.lease_empresa("1") as perdido:
+        assert perdido is None                        # recém-processado por "a"
+    time.sleep(1.1)
+    with nfs.lease_empresa("1") as perdido:
+        assert perdido is not None
+
+
+def test_lease_backend_desconhecido_falha_em_vez_de_liberar_geral(monkeypatch):
+    monkeypatch.setattr(nfs, "LEASE_BACKEND", "sqllite")
+    with pytest.raises(RuntimeError, match="LEASE_BACKEND"):
+        nfs.validar_lease_backend()
+    with pytest.raises(RuntimeError):
+        with nfs.lease_empresa("1"):
+            pass
+    monkeypatch.setattr(nfs, "LEASE_BACKEND", "")
+    nfs.validar_lease_backend()
+
+
+def test_meses_sujos_compartilhados_entre_nos_com_lease(monkeypatch, tmp_path):
+    _isolar_meses_sujos(monkeypatch, tmp_path)
+    _lease_sqlite(monkeypatch, tmp_path)
+    nfs.marcar_mes_sujo("12345678000190", "202601")
+    nfs.marcar_mes_sujo("12345678000190", "202603")
+    assert nfs._meses_sujos == {}                     # nada ficou só neste nó
+
+    # store fora: cai pro arquivo local e a leitura junta os dois
+    def fora(*a):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setitem(nfs._MESES_SUJOS_BACKENDS, "sqlite", (fora, nfs._sujos_sqlite_pegar))
+    nfs.marcar_mes_sujo("12345678000190", "202512")
+    monkeypatch.setitem(nfs._MESES_SUJOS_BACKENDS, "sqlite", (nfs._sujos_sqlite_marcar, nfs._sujos_sqlite_pegar))
+
+    monkeypatch.setattr(nfs, "WORKER_ID", "b")
+    assert nfs.pegar_meses_sujos("12345678000190", antes_de="202603") == ["202512", "202601"]
+    assert nfs.pegar_meses_sujos("12345678000190", antes_de="202603") == []
+    assert nfs.pegar_meses_sujos("12345678000190", antes_de="202604") == ["202603"]
+
+
+# =========================================================
+# ZIP
+# =========================================================
+def test_zip_config_ajusta_nivel_no_fallback_para_deflate(monkeypatch):
+    monkeypatch.setattr(nfs, "ZIP_COMPRESSAO", "zstd")
+    monkeypatch.setattr(nfs, "ZIP_NIVEL", 19)
+    monkeypatch.setattr(nfs, "zstandard", None)
+    metodo, nivel = nfs.zip_config()
+    assert (metodo, nivel) == (zipfile.ZIP_DEFLATED, 9)
+    assert zlib.decompress(nfs._zip_comprimir(XML, metodo, nivel), -15) == XML
+
+    monkeypatch.setattr(nfs, "ZIP_COMPRESSAO", "deflate")
+    monkeypatch.setattr(nfs, "ZIP_NIVEL", -5)
+    assert nfs.zip_config() == (zipfile.ZIP_DEFLATED, 0)
+
+
+def test_zip_config_nivel_menos_um_usa_padrao_do_metodo(monkeypatch):
+    monkeypatch.setattr(nfs, "ZIP_NIVEL", -1)
+    monkeypatch.setattr(nfs, "ZIP_COMPRESSAO", "deflate")
+    assert nfs.zip_config() == (zipfile.ZIP_DEFLATED, zlib.Z_DEFAULT_COMPRESSION)
+    monkeypatch.setattr(nfs, "ZIP_COMPRESSAO", "store")
+    assert nfs.zip_config() == (zipfile.ZIP_STORED, 0)
+    monkeypatch.setattr(nfs, "ZIP_COMPRESSAO", "zstd")
+    monkeypatch.setattr(nfs, "zstandard", object())
+    assert nfs.zip_config() == (93, 3)
+
+
+def _membros(arquivos, metodo, nivel=6):
+    return [(nome, zlib.crc32(b), len(b), nfs._zip_comprimir(b, metodo, nivel)) for nome, b in arquivos.items()]
+
+
+def test_zip_montar_le_de_volta_com_nome_nao_ascii(tmp_path):
+    arquivos = {f"{i}_01_abc.xml": XML + str(i).encode() * 200 for i in range(50)}
+    arquivos["nota_ção.xml"] = XML
+    for metodo in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+        caminho = tmp_path / f"m{metodo}.zip"
+        with open(caminho, "wb") as fp:
+            nfs._zip_montar(fp, _membros(arquivos, metodo), metodo, 6)
+        with zipfile.ZipFile(caminho) as z:
+            assert z.testzip() is None
+            assert z.namelist() == list(arquivos)
+            assert all(z.getinfo(n).compress_type == metodo for n in arquivos)
+            assert {n: z.read(n) for n in arquivos} == arquivos
+
+
+def test_zip_montar_fallback_zip64_com_muitos_membros(monkeypatch, tmp_path):
+    niveis = []
+    zipfile_original = zipfile.ZipFile
+
+    def zipfile_espiao(*a, **k):
+        niveis.append(k.get("compresslevel"))
+        return zipfile_original(*a, **k)
+
+    arquivos = {f"{i}.xml": b"<a/>" for i in range(0x10000 + 1)}
+    caminho = tmp_path / "grande.zip"
+    with open(caminho, "wb") as fp:
+        monkeypatch.setattr(nfs.zipfile, "ZipFile", zipfile_espiao)
+        nfs._zip_montar(fp, _membros(arquivos, zipfile.ZIP_DEFLATED, 9), zipfile.ZIP_DEFLATED, 9)
+        monkeypatch.undo()
+    assert niveis == [9]
+    with zipfile.ZipFile(caminho) as z:
+        assert len(z.namelist()) == len(arquivos)
+        assert z.read("65536.xml") == b"<a/>"
+
+
+def test_zip_preparar_membro_pula_download_falho(monkeypatch):
+    monkeypatch.setattr(nfs, "storage_download", lambda p: XML if p.endswith("ok.xml") else None)
+    assert nfs._zip_preparar_membro("x/falhou.xml", "falhou.xml", zipfile.ZIP_DEFLATED, 6) is None
+    nome, crc, tam, dados = nfs._zip_preparar_membro("x/ok.xml", "ok.xml", zipfile.ZIP_DEFLATED, 6)
+    assert (nome, crc, tam, zlib.decompress(dados, -15)) == ("ok.xml", zlib.crc32(XML), len(XML), XML)
+
+
+# =========================================================
+# registro de empresas
+# =========================================================
+def test_registrar_erro_faz_backoff_exponencial(monkeypatch):
+    monkeypatch.setattr(nfs, "INTERVALO_LOOP_SEGUNDOS", 90)
+    monkeypatch.setattr(nfs, "ERRO_BACKOFF_MAX_SEGUNDOS", 300)
+    estado = nfs.EmpresaEstado("12345678000190")
+    esperas = []
+    for _ in range(4):
+        antes = time.time()
+        estado.registrar_erro("ERRO_CERT")
+        esperas.append(round(estado.bloqueado_ate - antes))
+    assert esperas == [90, 180, 300, 300]
+    assert (estado.erros_seguidos, estado.ultimo_status) == (4, "ERRO_CERT")
+
+
+# =========================================================
+# spool + NSU
+# =========================================================
+class _Resp:
+    def __init__(self, status_code=200, payload=None):
+        self.status_code = status_code
+        self.headers = {"Content-Type": "application/json"}
+        self._payload = payload if payload is not None else {}
+        self.text = json.dumps(self._payload)
+        self.content = self.text.encode()
+
+    def json(self):
+        return self._payload
+
+
+class _SessaoADN:
+    def __init__(self, atrasos=None):
+        self.atrasos = atrasos or {}
+
+    def get(self, url, timeout=None):
+        nsu = int(url.split("/DFe/")[1].split("?")[0])
+        time.sleep(self.atrasos.get(nsu, 0))
+        return _Resp(payload={"LoteDFe": [{"NSU": nsu, "ArquivoXml": b64(XML + str(nsu).encode())}]})
+
+
+def test_nsu_nao_pula_nsu_menor_quando_spool_falha_fora_de_ordem(monkeypatch):
+    gravados = []
+
+    def spool(cnpj, nsu, itens):
+        if nsu == 12:
+            raise OSError("disco cheio")
+        gravados.append(nsu)
+        return len(itens)
+
+    monkeypatch.setattr(nfs, "spool_gravar_xmls", spool)
+    sessao = _SessaoADN(atrasos={10: 0.6, 11: 0.05, 12: 0.2})
+    res = nfs.baixar_e_salvar_xmls_por_nsu(sessao, "12345678000190", start_nsu=10, max_nsu=3, workers=3, batch_size=3)
+
+    assert gravados == [11]
+    assert res.max_nsu_ok == 9
+
+
+def test_nsu_avanca_pela_sequencia_continua(monkeypatch):
+    monkeypatch.setattr(nfs, "spool_gravar_xmls", lambda cnpj, nsu, itens: len(itens))
+    res = nfs.baixar_e_salvar_xmls_por_nsu(_SessaoADN(), "12345678000190", start_nsu=10, max_nsu=6, workers=3, batch_size=3)
+    assert (res.json_ok, res.max_nsu_ok, res.xml_geral) == (6, 15, 6)
+
+
+def test_subir_xml_marca_mes_sujo_mesmo_se_ja_existia(monkeypatch, tmp_path):
+    _isolar_meses_sujos(monkeypatch, tmp_path)
+    monkeypatch.setattr(nfs, "storage_exists", lambda p: True)
+    monkeypatch.setattr(nfs, "storage_upload", lambda *a, **k: pytest.fail("não deveria enviar"))
+    assert nfs.subir_xml_solto_storage("nfse_xml/12345678000190/202601/1_01_x.xml", "12345678000190", "202601", XML) is False
+    assert nfs.pegar_meses_sujos("12345678000190", antes_de="202603") == ["202601"]
+
+
+def _spool_isolado(monkeypatch, tmp_path):
+    _isolar_meses_sujos(monkeypatch, tmp_path)
+    monkeypatch.setattr(nfs, "SPOOL_DB_PATH", str(tmp_path / "spool.sqlite3"))
+
+
+def _spool_linhas():
+    with nfs.contextlib.closing(nfs._spool_conn()) as conn:
+        return conn.execute("SELECT storage_path, tentativas, proxima_em FROM spool ORDER BY id").fetchall()
+
+
+def test_spool_gravar_ignora_repetidos_e_e_transacional(monkeypatch, tmp_path):
+    _spool_isolado(monkeypatch, tmp_path)
+    assert nfs.spool_gravar_xmls("12.345.678/0001-90", 5, [("202601", XML), ("202602", XML + b" ")]) == 2
+    assert nfs.spool_gravar_xmls("12345678000190", 5, [("202601", XML)]) == 0
+
+    with pytest.raises(Exception):
+        nfs.spool_gravar_xmls("12345678000190", 6, [("202601", XML), (object(), XML)])  # 2º item não é gravável
+    caminhos = [r[0] for r in _spool_linhas()]
+    assert len(caminhos) == 2 and all("/5_0" in c for c in caminhos)
+
+
+def test_spool_pegar_lote_reserva_ate_o_claim_expirar(monkeypatch, tmp_path):
+    _spool_isolado(monkeypatch, tmp_path)
+    nfs.spool_gravar_xmls("12345678000190", 1, [("202601", XML)])
+    assert len(nfs._spool_pegar_lote(10)) == 1
+    assert nfs._spool_pegar_lote(10) == []           # reservado por outro drenador
+
+    monkeypatch.setattr(nfs, "SPOOL_CLAIM_SEGUNDOS", 0)
+    with nfs.contextlib.closing(nfs._spool_conn()) as conn:
+        conn.execute("UPDATE spool SET proxima_em = 0")  # claim "venceu"
+    assert len(nfs._spool_pegar_lote(10)) == 1
+
+
+def test_drenar_spool_apaga_enviados_e_faz_backoff_nas_falhas(monkeypatch, tmp_path):
+    _spool_isolado(monkeypatch, tmp_path)
+    nfs.spool_gravar_xmls("12345678000190", 1, [("202601", XML), ("202602", XML + b" ")])
+    monkeypatch.setattr(nfs, "storage_exists", lambda p: False)
+    monkeypatch.setattr(nfs, "storage_upload", lambda path, *a, **k: "/202601/" in path)
+
+    antes = time.time()
+    assert nfs.drenar_spool() == (1, 1)
+    [(caminho, tentativas, proxima_em)] = _spool_linhas()
+    assert "/202602/" in caminho and tentativas == 1 and proxima_em >= antes + 10
+    assert nfs.pegar_meses_sujos("12345678000190", antes_de="202603") == ["202601"]
+
+    monkeypatch.setattr(nfs, "storage_upload", lambda *a, **k: True)
+    assert nfs.drenar_spool() == (0, 0)               # ainda no backoff
+    with nfs.contextlib.closing(nfs._spool_conn()) as conn:
+        conn.execute("UPDATE spool SET proxima_em = 0")
+    assert nfs.drenar_spool() == (1, 0)
+    assert _spool_linhas() == []
+
+
+# =========================================================
+# perfil
+# =========================================================
+def test_perfil_relatorio_ranqueia_empresas_e_soma_bytes(monkeypatch, tmp_path):
+    monkeypatch.setattr(nfs, "PERFIL_ATIVO", True)
+    monkeypatch.setattr(nfs, "PERFIL_CPROFILE", True)
+    monkeypatch.setattr(nfs, "PERFIL_DIR", str(tmp_path))
+
+    @nfs.perfilar("fluxo_nfse_para_empresa")
+    def fluxo(atraso, nbytes):
+        with nfs.perfil_span("adn_get"):
+            time.sleep(atraso)
+        nfs.perfil_bytes("adn_get", nbytes)
+
+    nfs.perfil_iniciar_varredura()
+    with nfs.perfil_empresa("A"):
+        fluxo(0.01, 100)
+    with nfs.perfil_empresa("B"):
+        fluxo(0.1, 300)
+        fluxo(0.01, 5)
+    nfs.perfil_bytes("adn_get", 7)                     # fora de empresa: só no total da etapa
+
+    with open(nfs.perfil_relatorio_varredura()) as f:
+        rel = json.load(f)
+    assert [e["cnpj"] for e in rel["empresas"]] == ["B", "A"]
+    assert [e["bytes"] for e in rel["empresas"]] == [305, 100]
+    assert rel["empresas"][0]["etapas"]["fluxo_nfse_para_empresa"]["chamadas"] == 2
+    etapas = {e["etapa"]: e for e in rel["etapas"]}
+    assert etapas["adn_get"]["bytes"] == 412 and etapas["adn_get"]["chamadas"] == 3
+    assert [e["etapa"] for e in rel["etapas"]] == ["fluxo_nfse_para_empresa", "adn_get"]
+
+    pstats_arq = tmp_path / rel["pstats"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+        pstats_arq.with_suffix(ext).name for ext in (".json", ".pstats", ".txt")
+    )
+    assert "EMPRESAS" in pstats_arq.with_suffix(".txt").read_text(encoding="utf-8")